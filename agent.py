@@ -1,8 +1,9 @@
 from crewai import Agent
-from tool import LogRetrievalBasedOnIp
+from tool import LogRetrievalBasedOnIp, EntityPivotRetrieval
+from lookup import IpAccountLookup
 
 class QueryRewriterAgent(Agent):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, structured=False, **kwargs):
         kwargs.setdefault(
             "role",
             "Query Specification Agent"
@@ -45,7 +46,25 @@ class QueryRewriterAgent(Agent):
                 3. Convert vague conditions into explicit constraints when possible.
                 4. If multiple interpretations exist, choose the most conservative one and document assumptions.
                 5. Prefer database-aligned terminology over natural language phrasing.
-
+                """ + (
+                # 结构化模式下只输出检索工具参数JSON，避免与自由文本格式要求冲突
+                """
+                Output Format (STRICT):
+                Output ONLY a single JSON object with the fields requested by the task.
+                Do not wrap it in markdown and do not add any text before or after it.
+                The "Specification" field must contain the query specification in this format:
+                - Original Question:
+                - Extra Information Used:
+                - Query Intent:
+                - Target Entities (Tables):
+                - Required Attributes (Columns):
+                - Filters and Conditions:
+                - Aggregations / Grouping (if any):
+                - Ordering / Limits (if any):
+                - Assumptions and Uncertainties:
+                """
+                if structured else
+                """
                 Output Format (STRICT):
                 - Original Question:
                 - Extra Information Used:
@@ -57,6 +76,7 @@ class QueryRewriterAgent(Agent):
                 - Ordering / Limits (if any):
                 - Assumptions and Uncertainties:
                 """
+            )
         )
 
         super().__init__(*args, **kwargs)
@@ -154,7 +174,7 @@ class DataRetrievalExecutorAgent(Agent):
         )
         kwargs.setdefault("allow_delegation", False)
         kwargs.setdefault("verbose", True)
-        kwargs.setdefault("tools", [LogRetrievalBasedOnIp(result_as_answer=True)])
+        kwargs.setdefault("tools", [LogRetrievalBasedOnIp(result_as_answer=True), EntityPivotRetrieval(result_as_answer=True), IpAccountLookup(result_as_answer=True)])
 
         super().__init__(*args, **kwargs)
 
@@ -0,0 +1,229 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from model import estimate_tokens
+
+MAP_PROMPT = """
+        ===================
+        日志检索结果（第 {index}/{total} 批）：
+        {chunk}
+        ===================
+            这是一次大规模日志检索结果中的一个分批，请仅基于本批数据：
+            1. 识别其中的关键模式、异常行为和涉及的实体（IP、账号、系统、时间段）。
+            2. 统计关键指标（记录数、出现频次、时间分布等）。
+            3. 以简洁的要点列表输出本批的发现，不要输出最终结论或建议。"""
+
+REDUCE_PROMPT = """
+        ===================
+        分批分析结果（共 {total} 份，覆盖 {chunks} 批检索结果）：
+        {findings}
+        ===================
+            以上是对同一次日志检索结果按批次分析得到的局部发现，请合并它们：
+            1. 汇总各批次的关键模式，合并重复的实体和指标，保留跨批次的关联关系。
+            2. 若某些批次分析失败，在报告中注明这些批次的数据未被覆盖，不要推测其内容。
+            3. 基于汇总结果提供进一步的分析建议。
+            4. 总结关键发现和业务洞察，生成结构化的分析报告。
+        你需要输出：
+        - 分析过程，用<think> </think>标签包裹
+        - 结构化的分析报告，包含发现的问题、建议和总结"""
+
+COMBINE_PROMPT = """
+        ===================
+        分批分析结果（第 {index}/{total} 组）：
+        {findings}
+        ===================
+            以上是对同一次日志检索结果按批次分析得到的局部发现，请将它们合并为一份要点列表，
+            合并重复的实体和指标，保留所有异常行为和关键统计，不要输出最终结论或建议。"""
+
+
+def run_coroutine(coro):
+    """在同步代码中执行协程；若当前线程已有事件循环，则在独立线程中执行"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+
+class MapReduceAnalyzer:
+    """基于上下文窗口大小对日志检索结果进行分批并行分析（map）并合并结果（reduce）"""
+
+    def __init__(self, llm, max_concurrency: int = 4, reserved_tokens: int = 2048, retries: int = 2):
+        self.llm = llm
+        self.max_concurrency = max_concurrency
+        # 单个分批调用失败时的重试次数
+        self.retries = retries
+        # 为提示词模板和模型输出预留的token数
+        self.reserved_tokens = reserved_tokens
+
+    def _chunk_budget(self) -> int:
+        """单个分批可用的token数"""
+        return max(self.llm.get_context_window_size() - self.reserved_tokens, 256)
+
+    def fits(self, retrieval_result: str) -> bool:
+        """判断检索结果能否在一次分析中放入上下文窗口"""
+        return estimate_tokens(retrieval_result) <= self._chunk_budget()
+
+    def _split_long_line(self, line: str, budget: int) -> List[str]:
+        """将超出预算的单行按字符切分，逐字符累计token数（与estimate_tokens的估算口径一致）"""
+        pieces = []
+        start = 0
+        cjk = other = 0
+        for i, ch in enumerate(line):
+            is_cjk = "\u4e00" <= ch <= "\u9fff"
+            tokens = cjk + is_cjk + (other + (not is_cjk) + 2) // 3
+            if i > start and tokens > budget:
+                pieces.append(line[start:i])
+                start = i
+                cjk = other = 0
+            if is_cjk:
+                cjk += 1
+            else:
+                other += 1
+        if start < len(line):
+            pieces.append(line[start:])
+        return pieces
+
+    def _truncate(self, text: str, budget: int) -> str:
+        """将文本截断到token预算以内"""
+        if estimate_tokens(text) <= budget:
+            return text
+        return self._split_long_line(text, max(budget - 8, 1))[0] + "\n……（已截断）"
+
+    def _chunk_lines(self, context: List[str], group: List[str], chunks: List[List[str]], current: List[str],
+                     current_tokens: int):
+        """把一组行追加到当前分批，超出预算时另起一批并以context（所在章节标题和表头）开头"""
+        budget = self._chunk_budget()
+        context_tokens = sum(estimate_tokens(line) + 1 for line in context)
+        if context_tokens > budget // 2:
+            # 标题/表头本身过长时不再重复
+            context, context_tokens = [], 0
+        for line in group:
+            line_tokens = estimate_tokens(line) + 1
+            pieces = self._split_long_line(line, budget - context_tokens) if line_tokens > budget - context_tokens else [line]
+            for piece in pieces:
+                piece_tokens = estimate_tokens(piece) + 1
+                if current and current_tokens + piece_tokens > budget:
+                    chunks.append(current)
+                    current, current_tokens = list(context), context_tokens
+                current.append(piece)
+                current_tokens += piece_tokens
+        return current, current_tokens
+
+    def split(self, retrieval_result: str) -> List[str]:
+        """按token预算切分检索结果
+
+        逐行记录开头的说明文字、各级Markdown标题和最近的表头（表头行 + 分隔行），新分批以它们开头，
+        因此包含多个章节、多张表格的检索结果（实体分组、聚合统计、增量日志等）在每个分批中都保留所属章节和表头。
+        """
+        lines = retrieval_result.splitlines()
+        chunks = []
+        current = []
+        current_tokens = 0
+        preamble = []
+        headings = []
+        table_header = []
+        started = False
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            if line.startswith("#"):
+                # 新章节：保留上级标题，同级及下级标题和之前的表头不再适用
+                level = len(line) - len(line.lstrip("#"))
+                headings = [h for h in headings if len(h) - len(h.lstrip("#")) < level]
+                group, context = [line], preamble + headings
+                headings.append(line)
+                table_header = []
+                started = True
+            elif line.startswith("|") and i + 1 < len(lines) and lines[i + 1].startswith("| ---"):
+                group, context = [line, lines[i + 1]], preamble + headings
+                table_header = group
+                started = True
+                i += 1
+            elif not started:
+                # 第一个标题或表格之前的说明文字（检索策略、匹配总数等）
+                group, context = [line], []
+                preamble.append(line)
+            else:
+                group, context = [line], preamble + headings + table_header
+            i += 1
+            current, current_tokens = self._chunk_lines(context, group, chunks, current, current_tokens)
+        if current:
+            chunks.append(current)
+
+        return ["\n".join(chunk) for chunk in chunks]
+
+    async def _call_with_retry(self, prompt: str, label: str) -> str:
+        """调用LLM，失败时重试；重试耗尽后返回失败说明，由后续合并步骤在报告中注明"""
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.llm.acall(prompt)
+            except Exception as e:
+                if attempt == self.retries:
+                    print(f"[WARN] {label}分析失败: {str(e)}")
+                    return f"（{label}分析失败：{str(e)}，该部分数据未纳入分析）"
+                print(f"[WARN] {label}分析失败，第 {attempt + 1} 次重试: {str(e)}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def _gather(self, prompts: List[str], unit: str) -> List[str]:
+        """以有限并发度并行调用LLM，单个分批失败不影响其他分批"""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def _call(index: int, prompt: str) -> str:
+            async with semaphore:
+                return await self._call_with_retry(prompt, f"第 {index + 1} {unit}")
+
+        return await asyncio.gather(*[_call(i, prompt) for i, prompt in enumerate(prompts)])
+
+    def _group_findings(self, findings: List[str]) -> List[List[str]]:
+        """将局部发现按token预算分组"""
+        budget = self._chunk_budget()
+        groups = []
+        current = []
+        current_tokens = 0
+        for finding in findings:
+            finding_tokens = estimate_tokens(finding)
+            if current and current_tokens + finding_tokens > budget:
+                groups.append(current)
+                current = []
+                current_tokens = 0
+            current.append(finding)
+            current_tokens += finding_tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    async def aanalyze(self, retrieval_result: str) -> str:
+        chunks = self.split(retrieval_result)
+        print(f"[INFO] 检索结果超出上下文窗口，切分为 {len(chunks)} 批并行分析")
+        findings = await self._gather([
+            MAP_PROMPT.format(index=i + 1, total=len(chunks), chunk=chunk)
+            for i, chunk in enumerate(chunks)
+        ], "批")
+        findings = [f"### 第 {i + 1} 批\n{finding}" for i, finding in enumerate(findings)]
+
+        # 局部发现仍超出上下文窗口时，逐层合并
+        groups = self._group_findings(findings)
+        while len(groups) > 1:
+            findings = await self._gather([
+                COMBINE_PROMPT.format(index=i + 1, total=len(groups), findings="\n\n".join(group))
+                for i, group in enumerate(groups)
+            ], "组")
+            findings = [f"### 第 {i + 1} 组\n{finding}" for i, finding in enumerate(findings)]
+            next_groups = self._group_findings(findings)
+            if len(next_groups) >= len(groups):
+                # 无法继续压缩时，按份数平分预算截断每份发现，保证最终合并不超出上下文窗口
+                per_finding = self._chunk_budget() // len(findings)
+                findings = [self._truncate(finding, per_finding) for finding in findings]
+                break
+            groups = next_groups
+
+        return await self.llm.acall(REDUCE_PROMPT.format(
+            total=len(findings), chunks=len(chunks), findings="\n\n".join(findings)
+        ))
+
+    def analyze(self, retrieval_result: str) -> str:
+        """同步入口：map-reduce 分析检索结果并返回最终分析报告"""
+        return run_coroutine(self.aanalyze(retrieval_result))
@@ -0,0 +1,262 @@
+from crewai.tools import BaseTool
+from pydantic import BaseModel, Field
+from typing import Type, Optional, List, Dict, Tuple
+from datetime import datetime
+import argparse
+import json
+import os
+import sqlite3
+
+from tool import LogRetrievalBasedOnIp, EntityPivotRetrieval
+
+ip_account_db = os.environ.get("IP_ACCOUNT_DB", "ip_account.db")
+
+# 参与IP↔账号汇总的索引及其所属系统
+LOOKUP_SOURCES = {
+    "email_user_action_2026*": "邮件系统",
+    "pass_user_action_2026*": "通行证系统",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ip_account (
+    ip TEXT NOT NULL,
+    account TEXT NOT NULL,
+    system TEXT NOT NULL,
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (ip, account, system)
+);
+CREATE INDEX IF NOT EXISTS idx_ip_account_account ON ip_account (account);
+CREATE TABLE IF NOT EXISTS checkpoint (
+    index_name TEXT PRIMARY KEY,
+    last_timestamp INTEGER NOT NULL,
+    last_ids TEXT NOT NULL
+);
+"""
+
+UPSERT = """
+INSERT INTO ip_account (ip, account, system, first_seen, last_seen, count)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (ip, account, system) DO UPDATE SET
+    first_seen = MIN(first_seen, excluded.first_seen),
+    last_seen = MAX(last_seen, excluded.last_seen),
+    count = count + excluded.count
+"""
+
+
+class IpAccountIndex:
+    """本地IP↔账号汇总索引：从ES增量同步用户行为日志，按(ip, account, system)汇总首次/末次出现时间和次数
+
+    增量检查点记录每个索引已同步的最大时间戳及该时间戳上已处理的文档ID，
+    下次同步从该时间戳开始（含），跳过已处理的文档，避免同一时间戳的文档遗漏或重复计数。
+    """
+
+    def __init__(self, path: str = ip_account_db, page_size: int = 5000):
+        self.path = path
+        self.page_size = page_size
+        self.retrieval = LogRetrievalBasedOnIp()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path)
+
+    def _get_checkpoint(self, index_name: str) -> Tuple[Optional[int], set]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT last_timestamp, last_ids FROM checkpoint WHERE index_name = ?", (index_name,)
+            ).fetchone()
+        if row is None:
+            return None, set()
+        return row[0], set(json.loads(row[1]))
+
+    def refresh(self, index_name: str) -> int:
+        """从检查点开始用PIT + search_after增量同步一个索引，返回新处理的文档数"""
+        system = LOOKUP_SOURCES[index_name]
+        field_mapping = self.retrieval._get_field_mapping(index_name)
+        ip_field = field_mapping["ip_field"]
+        account_field = field_mapping.get("account_field")
+        time_field = field_mapping["timestamp_field"]
+        if not account_field:
+            raise ValueError(f"索引 {index_name} 未配置 account_field")
+
+        last_timestamp, last_ids = self._get_checkpoint(index_name)
+        # 缺少时间字段的文档会以最大哨兵值排在最后，必须排除，否则检查点会被推到哨兵值
+        filters = [{"exists": {"field": time_field}}]
+        if last_timestamp is not None:
+            filters.append({"range": {time_field: {"gte": last_timestamp}}})
+        query = {"bool": {"filter": filters}}
+
+        es = self.retrieval._get_es_client(index_name)
+        pit = es.open_point_in_time(index=index_name, keep_alive="2m")["id"]
+        processed = 0
+        search_after = None
+        try:
+            while True:
+                body = {
+                    "query": query,
+                    "pit": {"id": pit, "keep_alive": "2m"},
+                    "sort": [{time_field: "asc"}, {"_shard_doc": "asc"}],
+                    "_source": [ip_field, account_field, time_field],
+                    "size": self.page_size,
+                }
+                if search_after is not None:
+                    body["search_after"] = search_after
+                response = es.search(body=body, filter_path=["pit_id", "hits.hits._id", "hits.hits._source", "hits.hits.sort"])
+                pit = response.get("pit_id", pit)
+                hits = response.get("hits", {}).get("hits", [])
+                if not hits:
+                    break
+
+                rollup: Dict[Tuple[str, str], List[int]] = {}
+                for hit in hits:
+                    timestamp = hit["sort"][0]
+                    if timestamp == last_timestamp and hit["_id"] in last_ids:
+                        continue
+                    if last_timestamp is None or timestamp > last_timestamp:
+                        last_timestamp, last_ids = timestamp, set()
+                    last_ids.add(hit["_id"])
+                    processed += 1
+
+                    source = hit["_source"]
+                    ip = source.get(ip_field)
+                    account = source.get(account_field)
+                    if not ip or not account:
+                        continue
+                    seen = rollup.setdefault((str(ip), str(account)), [timestamp, timestamp, 0])
+                    seen[0] = min(seen[0], timestamp)
+                    seen[1] = max(seen[1], timestamp)
+                    seen[2] += 1
+
+                # 每页提交一次，汇总数据与检查点在同一事务中更新
+                with self._connect() as conn:
+                    conn.executemany(UPSERT, [
+                        (ip, account, system, first, last, count)
+                        for (ip, account), (first, last, count) in rollup.items()
+                    ])
+                    if last_timestamp is not None:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO checkpoint (index_name, last_timestamp, last_ids) VALUES (?, ?, ?)",
+                            (index_name, last_timestamp, json.dumps(sorted(last_ids))),
+                        )
+                search_after = hits[-1]["sort"]
+        finally:
+            es.close_point_in_time(id=pit)
+            es.close()
+
+        print(f"[INFO] {index_name} 增量同步 {processed} 条文档")
+        return processed
+
+    def refresh_all(self) -> Dict[str, int]:
+        return {index_name: self.refresh(index_name) for index_name in LOOKUP_SOURCES}
+
+    def checkpoints(self) -> Dict[str, Optional[str]]:
+        """各索引已同步到的时间，从未同步的索引为None"""
+        result = {}
+        for index_name in LOOKUP_SOURCES:
+            last_timestamp, _ = self._get_checkpoint(index_name)
+            result[index_name] = self._format_timestamp(last_timestamp) if last_timestamp is not None else None
+        return result
+
+    def lookup(self, ip: Optional[str] = None, account: Optional[str] = None) -> List[dict]:
+        """按IP和/或账号查询汇总记录，按末次出现时间倒序"""
+        conditions = []
+        params = []
+        if ip:
+            conditions.append("ip = ?")
+            params.append(ip)
+        if account:
+            conditions.append("account = ?")
+            params.append(account)
+        if not conditions:
+            raise ValueError("至少需要提供IP或账号")
+
+        sql = (
+            "SELECT ip, account, system, first_seen, last_seen, count FROM ip_account WHERE "
+            + " AND ".join(conditions)
+            + " ORDER BY last_seen DESC"
+        )
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [
+            {
+                "ip": row[0],
+                "account": row[1],
+                "system": row[2],
+                "first_seen": self._format_timestamp(row[3]),
+                "last_seen": self._format_timestamp(row[4]),
+                "count": row[5],
+            }
+            for row in rows
+        ]
+
+    def _format_timestamp(self, value: int) -> str:
+        # 日期类型字段的排序值为毫秒时间戳
+        seconds = value / 1000 if value > 10 ** 11 else value
+        return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class IpAccountLookupToolInput(BaseModel):
+    """Input schema for IpAccountLookup."""
+    Ip: Optional[str] = Field(None, description="目标IP地址")
+    Account: Optional[str] = Field(None, description="用户账号")
+    StartTime: Optional[str] = Field(None, description="仅在本地索引未同步、回退到ELK检索时使用的开始时间，格式为YYYY-MM-DD HH:MM:SS")
+    EndTime: Optional[str] = Field(None, description="仅在本地索引未同步、回退到ELK检索时使用的结束时间，格式为YYYY-MM-DD HH:MM:SS")
+
+
+class IpAccountLookup(BaseTool):
+    name: str = "IpAccountLookup"
+    description: str = """IP与账号关联快速查询工具：基于本地汇总索引，毫秒级返回某IP使用过的账号或某账号使用过的IP，以及所属系统、首次/末次出现时间和次数；本地尚未同步的系统会自动回退到ELK检索\n\n    When to use:\n    - 当需要查询某个IP在哪些账号上使用过时\n    - 当需要查询某个账号使用过哪些IP时"""
+    args_schema: Type[BaseModel] = IpAccountLookupToolInput
+
+    def _run(self, Ip: Optional[str] = None, Account: Optional[str] = None,
+             StartTime: Optional[str] = None, EndTime: Optional[str] = None) -> str:
+        if not Ip and not Account:
+            return "错误: 至少需要提供IP或账号。"
+        index = IpAccountIndex()
+        checkpoints = index.checkpoints()
+        progress = "本地索引同步进度:\n" + "\n".join(
+            f"- {index_name}（{LOOKUP_SOURCES[index_name]}）: "
+            + (f"已同步至 {synced}" if synced else "从未同步，已回退到ELK检索")
+            for index_name, synced in checkpoints.items()
+        ) + "\n\n"
+
+        sections = []
+        synced_systems = {LOOKUP_SOURCES[index_name] for index_name, synced in checkpoints.items() if synced}
+        if synced_systems:
+            rows = [row for row in index.lookup(ip=Ip, account=Account) if row["system"] in synced_systems]
+            if rows:
+                sections.append(f"本地索引找到 {len(rows)} 条关联记录:\n\n" + LogRetrievalBasedOnIp()._format_to_markdown(rows))
+            else:
+                sections.append(f"在已同步的数据范围内未找到 IP {Ip or '-'} / 账号 {Account or '-'} 的关联记录\n")
+
+        # 从未同步的系统直接检索ELK，避免把空的本地索引当作"没有关联"
+        unsynced = [index_name for index_name, synced in checkpoints.items() if not synced]
+        if unsynced:
+            sections.append("ELK检索结果（本地索引未同步的系统）:\n\n" + EntityPivotRetrieval()._run(
+                Indexes=unsynced,
+                Ips=[Ip] if Ip else [],
+                Accounts=[Account] if Account else [],
+                StartTime=StartTime,
+                EndTime=EndTime,
+            ))
+        return progress + "\n".join(sections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地IP↔账号汇总索引")
+    parser.add_argument("--refresh", action="store_true", help="从ELK增量同步全部索引")
+    parser.add_argument("--ip", help="查询该IP使用过的账号")
+    parser.add_argument("--account", help="查询该账号使用过的IP")
+    args = parser.parse_args()
+
+    if args.refresh:
+        print(IpAccountIndex().refresh_all())
+    if args.ip or args.account:
+        print(IpAccountLookup()._run(Ip=args.ip, Account=args.account))
+    if not (args.refresh or args.ip or args.account):
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
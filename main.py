@@ -3,9 +3,12 @@ from rag import Analyzer
 from crewai import Crew, Process, Task
 from crewai.flow.flow import Flow, listen, start, router
 from agent import QueryRewriterAgent, DataRetrievalEngineerAgent, DataRetrievalExecutorAgent, DataRetrievalAnalyzer
+from tool import LogRetrievalBasedOnIp
 from task import QueryRewriteTask, DataRetrievalTask, DataAnalysisTask
 from model import CustomLLM
+from analysis import MapReduceAnalyzer
 import os
+import re
 
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
@@ -19,26 +22,42 @@ load_dotenv()
 api_key = os.environ.get("OPENAI_API_KEY", "")
 model_name = os.environ.get("OPENAI_MODEL_NAME", "")
 endpoint = os.environ.get("OPENAI_ENDPOINT", "")
-llm = CustomLLM(api_key=api_key, model=model_name, endpoint=endpoint)
+# 网关的每分钟请求数/token数配额，未配置时不限制
+requests_per_minute = int(os.environ.get("OPENAI_RPM") or 0) or None
+tokens_per_minute = int(os.environ.get("OPENAI_TPM") or 0) or None
+llm = CustomLLM(
+    api_key=api_key,
+    model=model_name,
+    endpoint=endpoint,
+    requests_per_minute=requests_per_minute,
+    tokens_per_minute=tokens_per_minute,
+)
+
+# 出现这些词说明问题涉及账号关联或IP范围，单IP检索参数无法完整覆盖
+PIVOT_KEYWORDS = ("账号", "账户", "用户", "子网", "网段")
 
 class MainFlowState(BaseModel):
     userInput: str = Field("", description="The user input for the flow")
 
 
 class MainFlow(Flow[MainFlowState]):
-    def __init__(self):
+    def __init__(self, structured_retrieval: bool = True):
         super().__init__(tracing=True)
+        # 查询改写同时输出结构化检索参数；仅当问题是单IP直接检索且校验通过时跳过检索执行Agent
+        self.structured_retrieval = structured_retrieval
+        self.retrieval_spec = None
 
     @start()
     def QueryRewrite(self):
         analyzer = Analyzer()
         self.extra_information = analyzer.analyze(self.state.userInput)
         self.extra_information = {"所需要的日志可能包含在index_name中": "email_user_action_2026*"}
-        agent = QueryRewriterAgent(llm=llm)
+        agent = QueryRewriterAgent(llm=llm, structured=self.structured_retrieval)
         rewrite_task = QueryRewriteTask(
             user_question=self.state.userInput,
             extra_information=self.extra_information,
-            agent=agent  # Writer leads, but can delegate research to researcher
+            agent=agent,  # Writer leads, but can delegate research to researcher
+            structured=self.structured_retrieval,
         )
         crew = Crew(
             agents=[agent],
@@ -47,16 +66,41 @@ class MainFlow(Flow[MainFlowState]):
             verbose=True
         )
         result = crew.kickoff()
-        return result.raw
+        spec = result.pydantic if self.structured_retrieval else None
+        if spec is None:
+            return result.raw
+        self.retrieval_spec = spec.Retrieval
+        # 交给检索Agent的仍是完整的自由文本规格说明
+        return spec.Specification
     
+    def _covers_question(self, spec) -> bool:
+        """结构化参数只覆盖单IP直接检索：问题中恰好一个IP，没有CIDR写法、账号或范围意图，且未指定账号"""
+        question = self.state.userInput
+        ips = set(re.findall(r"(?<![\d.])\d{1,3}(?:\.\d{1,3}){3}(?!\d)", question))
+        has_cidr = re.search(r"\d{1,3}(?:\.\d{1,3}){3}/\d{1,2}", question)
+        has_pivot = any(keyword in question for keyword in PIVOT_KEYWORDS)
+        return ips == {spec.Ip} and not has_cidr and not has_pivot and not spec.Account
+
     @listen("QueryRewrite")
     def DataRetrieval(self, RewriteQuery):
+        if self.retrieval_spec is not None and self._covers_question(self.retrieval_spec):
+            retrieval = LogRetrievalBasedOnIp()
+            error = retrieval.validate_spec(self.retrieval_spec)
+            if error is None:
+                return retrieval._run(**self.retrieval_spec.model_dump())
+            print(f"[WARN] 结构化检索参数校验失败，改由检索Agent执行: {error}")
+
         Executor = DataRetrievalExecutorAgent(llm=llm) 
         result = Executor.kickoff(RewriteQuery)
         return result
 
     @listen("DataRetrieval")
     def DataRetrievalEngineer(self, ExecutorResult):
+        # 检索结果超出上下文窗口时，分批并行分析后合并
+        map_reduce = MapReduceAnalyzer(llm=llm)
+        if not map_reduce.fits(str(ExecutorResult)):
+            return map_reduce.analyze(str(ExecutorResult))
+
         Analyzer = DataRetrievalAnalyzer(llm=llm)
         retrieval_task = DataAnalysisTask(
             retrieval_result=ExecutorResult,
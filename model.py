@@ -1,8 +1,20 @@
 from crewai import BaseLLM
 from typing import Any, Dict, List, Optional, Union
+import time
 import httpx
 import requests
 
+from ratelimit import get_limiter
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本token数：CJK字符按1个token计，其余字符按约3个字符1个token计"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "\u4e00" <= ch <= "\u9fff")
+    return cjk + (len(text) - cjk + 2) // 3
+
+
 class CustomLLM(BaseLLM):
     def __init__(
         self,
@@ -13,6 +25,10 @@ class CustomLLM(BaseLLM):
         timeout: int = 120,
         max_retries: int = 3,
         top_p: float = 1.0,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_concurrency: int = 8,
+        max_output_tokens: int = 1024,
         **kwargs: Any,
     ):
         super().__init__(model=model, temperature=temperature, **kwargs)
@@ -22,6 +38,27 @@ class CustomLLM(BaseLLM):
         self.max_retries = max_retries
         self.top_p = top_p
         self.temperature = temperature
+        # 预估token配额时为模型输出预留的token数
+        self.max_output_tokens = max_output_tokens
+        # 同一网关的所有实例共享限流器
+        self.limiter = get_limiter(
+            endpoint,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_concurrency=max_concurrency,
+        )
+
+    def _estimate_request_tokens(self, messages: List[Dict[str, str]]) -> int:
+        return sum(estimate_tokens(str(m.get("content") or "")) for m in messages) + self.max_output_tokens
+
+    def _retry_after(self, response) -> float:
+        try:
+            return float(response.headers.get("Retry-After", 1))
+        except (TypeError, ValueError):
+            return 1.0
+
+    def _used_tokens(self, result: dict) -> Optional[int]:
+        return (result.get("usage") or {}).get("total_tokens")
 
     def call(
         self,
@@ -45,19 +82,35 @@ class CustomLLM(BaseLLM):
         if tools and self.supports_function_calling():
             payload["tools"] = tools
 
-        response = requests.post(
-            self.endpoint,
-            headers={
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=300,
-        )
-        response.raise_for_status()
+        estimated = self._estimate_request_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(estimated)
+            started = time.monotonic()
+            throttled, retry_after = False, None
+            try:
+                response = requests.post(
+                    self.endpoint,
+                    headers={
+                        "Authorization": f"Bearer {self.api_key}",
+                        "Content-Type": "application/json",
+                    },
+                    json=payload,
+                    timeout=300,
+                )
+                throttled = response.status_code == 429
+                if throttled:
+                    retry_after = self._retry_after(response)
+            finally:
+                # 无论请求是否异常都先归还槽位，响应解码放在归还之后
+                self.limiter.release(time.monotonic() - started, throttled=throttled,
+                                     retry_after=retry_after, estimated_tokens=estimated)
 
-        result = response.json()
-        return result["choices"][0]["message"]["content"]
+            if throttled and attempt < self.max_retries:
+                continue
+            response.raise_for_status()
+            result = response.json()
+            self.limiter.record_usage(estimated, self._used_tokens(result))
+            return result["choices"][0]["message"]["content"]
 
     def supports_function_calling(self) -> bool:
         return True
@@ -69,10 +122,27 @@ class CustomLLM(BaseLLM):
         if isinstance(messages, str):
             messages = [{"role": "user", "content": messages}]
         payload = {"model": self.model, "messages": messages, "temperature": self.temperature}
+        estimated = self._estimate_request_tokens(messages)
         async with httpx.AsyncClient(timeout=self.timeout) as client:
-            resp = await client.post(self.endpoint, headers={
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }, json=payload)
-            resp.raise_for_status()
-            return resp.json()["choices"][0]["message"]["content"]
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.aacquire(estimated)
+                started = time.monotonic()
+                throttled, retry_after = False, None
+                try:
+                    resp = await client.post(self.endpoint, headers={
+                        "Authorization": f"Bearer {self.api_key}",
+                        "Content-Type": "application/json"
+                    }, json=payload)
+                    throttled = resp.status_code == 429
+                    if throttled:
+                        retry_after = self._retry_after(resp)
+                finally:
+                    self.limiter.release(time.monotonic() - started, throttled=throttled,
+                                         retry_after=retry_after, estimated_tokens=estimated)
+
+                if throttled and attempt < self.max_retries:
+                    continue
+                resp.raise_for_status()
+                result = resp.json()
+                self.limiter.record_usage(estimated, self._used_tokens(result))
+                return result["choices"][0]["message"]["content"]
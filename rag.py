@@ -6,6 +6,7 @@ import uuid
 import os
 
 from dotenv import load_dotenv
+from singleflight import SingleFlight
 
 load_dotenv()
 
@@ -13,6 +14,9 @@ api_key = os.environ.get("EMBEDDING_OPENAI_API_KEY", "")
 model_name = os.environ.get("EMBEDDING_OPENAI_MODEL_NAME", "")
 endpoint = os.environ.get("EMBEDDING_OPENAI_ENDPOINT", "")
 
+# 相同文本的并发嵌入请求只发起一次HTTP调用
+embedding_flight = SingleFlight("embedding")
+
 class EmbeddingService:
     """嵌入向量服务类"""
     
@@ -22,7 +26,14 @@ class EmbeddingService:
         self.model_name = model_name  # 模型名称应该赋值给model_name
     
     def get_embedding(self, text: str) -> List[float]:
-        """获取文本嵌入向量"""
+        """获取文本嵌入向量，并发的相同请求会被合并"""
+        return embedding_flight.do((self.api_url, self.model_name, text), self._request_embedding, text)
+
+    async def aget_embedding(self, text: str) -> List[float]:
+        """异步获取文本嵌入向量，与同步调用共享进行中的相同请求"""
+        return await embedding_flight.ado((self.api_url, self.model_name, text), self._request_embedding, text)
+
+    def _request_embedding(self, text: str) -> List[float]:
         headers = {
             "Authorization": f"Bearer {self.api_token}",
             "Content-Type": "application/json"
@@ -0,0 +1,214 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """令牌桶：按每分钟配额匀速补充，容量为一分钟的配额"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """距离可以取出amount个令牌还需等待的秒数（超出容量的请求按满桶计算）"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def adjust(self, delta: float):
+        """按实际消耗修正桶内令牌（delta为正表示多扣）"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+
+class _Waiter:
+    """排队中的调用方：同步调用方用Event等待，异步调用方用所属事件循环上的Future等待"""
+
+    def __init__(self, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.tokens = tokens
+        self.granted = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AdaptiveLimiter:
+    """LLM网关限流器：请求数/token数双令牌桶 + AIMD自适应并发 + 先到先得的公平排队
+
+    - 收到429时并发度减半，并按Retry-After暂停放行
+    - 请求成功且延迟低于目标时，并发度每轮加1
+    - 延迟超过目标时，并发度小幅下调
+
+    同步和异步调用方共用一个FIFO队列，槽位在归还或配额恢复时由队首依次分配；
+    异步调用方在事件循环上等待，不占用线程池线程。
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        latency_target: float = 60.0,
+    ):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.latency_target = latency_target
+        self.concurrency = float(max(min_concurrency, min(2, max_concurrency)))
+        self.in_flight = 0
+        self.throttled = 0
+        self._blocked_until = 0.0
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._timer_deadline = 0.0
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = self._blocked_until - time.monotonic()
+        if self.request_bucket:
+            wait = max(wait, self.request_bucket.wait_time(1))
+        if self.token_bucket:
+            wait = max(wait, self.token_bucket.wait_time(tokens))
+        return wait
+
+    def _dispatch(self):
+        """按FIFO顺序把空闲槽位分配给队首调用方（需持有锁）"""
+        while self._queue and self.in_flight < int(self.concurrency):
+            waiter = self._queue[0]
+            wait = self._wait_time(waiter.tokens)
+            if wait > 0:
+                self._schedule(wait)
+                return
+            self._queue.popleft()
+            if self.request_bucket:
+                self.request_bucket.consume(1)
+            if self.token_bucket:
+                self.token_bucket.consume(min(waiter.tokens, self.token_bucket.capacity))
+            self.in_flight += 1
+            waiter.grant()
+
+    def _schedule(self, wait: float):
+        """配额不足时在配额恢复后重新分配"""
+        deadline = time.monotonic() + wait
+        if self._timer is not None and self._timer.is_alive() and self._timer_deadline <= deadline:
+            return
+        self._timer_deadline = deadline
+        self._timer = threading.Timer(wait, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._dispatch()
+
+    def _refund(self, tokens: int):
+        """归还已扣除的槽位与配额（需持有锁）"""
+        self.in_flight -= 1
+        if self.request_bucket:
+            self.request_bucket.adjust(-1)
+        if self.token_bucket:
+            self.token_bucket.adjust(-min(tokens, self.token_bucket.capacity))
+
+    def acquire(self, tokens: int = 0):
+        """阻塞直到轮到当前调用方且配额充足"""
+        waiter = _Waiter(tokens)
+        with self._lock:
+            self._queue.append(waiter)
+            self._dispatch()
+        waiter.event.wait()
+
+    async def aacquire(self, tokens: int = 0):
+        """异步获取槽位；等待中被取消时退出队列，若已分配到槽位则立即归还"""
+        waiter = _Waiter(tokens, loop=asyncio.get_running_loop())
+        with self._lock:
+            self._queue.append(waiter)
+            self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self._refund(tokens)
+                else:
+                    self._queue.remove(waiter)
+                self._dispatch()
+            raise
+
+    def release(self, latency: float, throttled: bool = False, retry_after: Optional[float] = None,
+                estimated_tokens: int = 0):
+        """归还并发槽位，并根据本次请求的结果调整并发度；被429拒绝的请求退还预扣的token配额"""
+        with self._lock:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                self._blocked_until = max(self._blocked_until, time.monotonic() + (retry_after or 1.0))
+                if self.token_bucket:
+                    self.token_bucket.adjust(-min(estimated_tokens, self.token_bucket.capacity))
+            elif latency > self.latency_target:
+                self.concurrency = max(self.min_concurrency, self.concurrency * 0.9)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._dispatch()
+
+    def record_usage(self, estimated_tokens: int, used_tokens: Optional[int]):
+        """按网关返回的实际用量修正token配额"""
+        if not self.token_bucket or used_tokens is None:
+            return
+        with self._lock:
+            self.token_bucket.adjust(used_tokens - min(estimated_tokens, self.token_bucket.capacity))
+            self._dispatch()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "concurrency": round(self.concurrency, 2),
+                "in_flight": self.in_flight,
+                "queued": len(self._queue),
+                "throttled": self.throttled,
+            }
+
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(endpoint: str, **kwargs) -> AdaptiveLimiter:
+    """同一网关地址的所有LLM实例共享一个限流器"""
+    with _limiters_lock:
+        limiter = _limiters.get(endpoint)
+        if limiter is None:
+            limiter = AdaptiveLimiter(**kwargs)
+            _limiters[endpoint] = limiter
+        return limiter
@@ -0,0 +1,76 @@
+import asyncio
+import inspect
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """请求合并：相同key的并发请求共享同一次执行及其结果，同步与异步调用方可混用"""
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self._requests = 0
+        self._executions = 0
+        self._deduplicated = 0
+
+    def _acquire(self, key: Hashable) -> Tuple[Future, bool]:
+        """返回key对应的进行中请求，以及当前调用方是否需要负责执行"""
+        with self._lock:
+            self._requests += 1
+            future = self._calls.get(key)
+            if future is not None:
+                self._deduplicated += 1
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            self._executions += 1
+            return future, True
+
+    def _release(self, key: Hashable, future: Future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def _execute(self, key: Hashable, future: Future, fn: Callable, args, kwargs):
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._release(key, future)
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """同步调用：若已有相同key的请求在执行，则等待并复用其结果"""
+        future, leader = self._acquire(key)
+        if leader:
+            self._execute(key, future, fn, args, kwargs)
+        return future.result()
+
+    async def ado(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """异步调用：fn可以是协程函数，也可以是普通函数（在线程池中执行）"""
+        future, leader = self._acquire(key)
+        if leader:
+            if inspect.iscoroutinefunction(fn):
+                try:
+                    future.set_result(await fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+                finally:
+                    self._release(key, future)
+            else:
+                await asyncio.to_thread(self._execute, key, future, fn, args, kwargs)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回请求计数：总请求数、实际执行数、被合并的请求数"""
+        with self._lock:
+            return {
+                "name": self.name,
+                "requests": self._requests,
+                "executions": self._executions,
+                "deduplicated": self._deduplicated,
+                "in_flight": len(self._calls),
+            }
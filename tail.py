@@ -0,0 +1,198 @@
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from crewai import Crew, Process
+
+from agent import DataRetrievalAnalyzer
+from analysis import MapReduceAnalyzer
+from task import DataAnalysisTask
+from tool import EntityPivotRetrieval, FIELD_MAPPINGS
+
+
+class WatchlistTail:
+    """IP监控列表实时跟踪：按集群合并为一次 _msearch 轮询所有索引，只拉取高水位之后的新日志
+
+    每个索引维护基于映射时间字段的高水位（最大排序值及该值上已输出的文档ID），
+    下次轮询从高水位开始（含），跳过已输出的文档，保证同一时间戳的文档不遗漏、不重复。
+    每轮内用PIT + search_after（时间字段 + _shard_doc）翻页，直到所有索引都返回不满一页为止，
+    因此同一时间戳的大量文档或突发流量都不会使跟踪停滞或落后。
+    """
+
+    def __init__(self, ips: List[str], indexes: Optional[List[str]] = None, interval: float = 30.0,
+                 lookback: timedelta = timedelta(minutes=5), page_size: int = 1000):
+        self.ips = list(dict.fromkeys(ips))
+        self.indexes = indexes or list(FIELD_MAPPINGS.keys())
+        self.interval = interval
+        # 首次轮询从当前时间往前回溯的时长
+        self.lookback = lookback
+        self.page_size = page_size
+        self.retrieval = EntityPivotRetrieval()
+        self.high_water: Dict[str, Tuple[Optional[int], set]] = {index: (None, set()) for index in self.indexes}
+
+    def _clusters(self) -> Dict[str, List[str]]:
+        """按ES集群地址对索引分组"""
+        clusters = defaultdict(list)
+        for index in self.indexes:
+            clusters[self.retrieval._get_es_url(index)].append(index)
+        return clusters
+
+    def _search_body(self, index: str, pit: str, search_after: Optional[list]) -> dict:
+        field_mapping = self.retrieval._get_field_mapping(index)
+        time_field = field_mapping["timestamp_field"]
+        last_timestamp, _ = self.high_water[index]
+        if last_timestamp is None:
+            # 与 LogRetrievalBasedOnIp 一致，使用秒级时间戳作为起始时间
+            time_range = {"gte": str(int((datetime.now() - self.lookback).timestamp()))}
+        else:
+            time_range = {"gte": last_timestamp}
+        body = {
+            "query": {
+                "bool": {
+                    "must": [
+                        self.retrieval._terms_query(field_mapping["ip_field"], self.ips),
+                        {"range": {time_field: time_range}},
+                    ]
+                }
+            },
+            "pit": {"id": pit, "keep_alive": "1m"},
+            "sort": [{time_field: "asc"}, {"_shard_doc": "asc"}],
+            "size": self.page_size,
+        }
+        if search_after is not None:
+            body["search_after"] = search_after
+        return body
+
+    def _collect(self, index: str, hits: List[dict]) -> List[dict]:
+        """过滤已输出的文档并推进高水位"""
+        ip_field = self.retrieval._get_field_mapping(index)["ip_field"]
+        ip_fields = ip_field if isinstance(ip_field, list) else [ip_field]
+        last_timestamp, last_ids = self.high_water[index]
+        events = []
+        for hit in hits:
+            timestamp = hit["sort"][0]
+            if timestamp == last_timestamp and hit["_id"] in last_ids:
+                continue
+            if last_timestamp is None or timestamp > last_timestamp:
+                last_timestamp, last_ids = timestamp, set()
+            last_ids.add(hit["_id"])
+
+            source = hit["_source"]
+            matched = set()
+            for field in ip_fields:
+                matched.update(v for v in self.retrieval._get_field_values(source, field) if v in self.ips)
+            events.append({"index": index, "ips": sorted(matched), "timestamp": timestamp, "source": source})
+        self.high_water[index] = (last_timestamp, last_ids)
+        return events
+
+    def _poll_cluster(self, url: str, indexes: List[str]) -> List[dict]:
+        """对一个集群的所有索引翻页拉取新日志，每页一次 _msearch"""
+        es = self.retrieval._get_es_client(indexes[0])
+        pits = {}
+        events = []
+        try:
+            for index in indexes:
+                try:
+                    pits[index] = es.open_point_in_time(index=index, keep_alive="1m")["id"]
+                except Exception as e:
+                    print(f"[WARN] 索引 {index} 打开PIT失败: {str(e)}")
+
+            # 仍有下一页的索引及其 search_after 游标
+            pending = {index: None for index in pits}
+            while pending:
+                searches = []
+                for index, search_after in pending.items():
+                    searches.append({})
+                    searches.append(self._search_body(index, pits[index], search_after))
+                response = es.msearch(searches=searches)
+
+                next_pending = {}
+                for index, result in zip(list(pending), response["responses"]):
+                    if "error" in result:
+                        print(f"[WARN] 索引 {index} 查询失败: {result['error']}")
+                        continue
+                    pits[index] = result.get("pit_id", pits[index])
+                    hits = result["hits"]["hits"]
+                    events.extend(self._collect(index, hits))
+                    if len(hits) == self.page_size:
+                        next_pending[index] = hits[-1]["sort"]
+                pending = next_pending
+        except Exception as e:
+            print(f"[WARN] 集群 {url} 查询失败: {str(e)}")
+        finally:
+            for pit in pits.values():
+                try:
+                    es.close_point_in_time(id=pit)
+                except Exception:
+                    pass
+            es.close()
+        return events
+
+    def poll(self) -> List[dict]:
+        """执行一轮轮询，返回所有索引的新日志"""
+        events = []
+        for url, indexes in self._clusters().items():
+            events.extend(self._poll_cluster(url, indexes))
+        return events
+
+    def stream(self, max_rounds: Optional[int] = None) -> Iterator[List[dict]]:
+        """按轮询间隔持续产出每一轮的新日志（无新日志的轮次不产出）"""
+        rounds = 0
+        while max_rounds is None or rounds < max_rounds:
+            started = time.monotonic()
+            events = self.poll()
+            if events:
+                yield events
+            rounds += 1
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def format_delta(self, events: List[dict]) -> str:
+        by_index = defaultdict(list)
+        for event in events:
+            by_index[event["index"]].append(event["source"])
+        sections = [f"找到 {len(events)} 条新记录:\n"]
+        for index, docs in by_index.items():
+            sections.append(f"### 索引 {index}（{len(docs)} 条）\n\n" + self.retrieval._format_to_markdown(docs))
+        return "\n".join(sections)
+
+
+def analyze_delta(llm, retrieval_result: str) -> str:
+    """对增量日志执行与 MainFlow 相同的分析流程"""
+    map_reduce = MapReduceAnalyzer(llm=llm)
+    if not map_reduce.fits(retrieval_result):
+        return map_reduce.analyze(retrieval_result)
+
+    analyzer = DataRetrievalAnalyzer(llm=llm)
+    crew = Crew(
+        agents=[analyzer],
+        tasks=[DataAnalysisTask(retrieval_result=retrieval_result, agent=analyzer)],
+        process=Process.sequential,
+        verbose=True
+    )
+    return crew.kickoff().raw
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IP监控列表实时跟踪")
+    parser.add_argument("ips", nargs="+", help="监控的IP地址")
+    parser.add_argument("--index", action="append", dest="indexes", help="跟踪的索引，可重复指定，默认全部索引")
+    parser.add_argument("--interval", type=float, default=30.0, help="轮询间隔（秒）")
+    parser.add_argument("--analyze", action="store_true", help="对每轮新增日志调用LLM分析")
+    args = parser.parse_args()
+
+    llm = None
+    if args.analyze:
+        from main import llm
+
+    tail = WatchlistTail(args.ips, indexes=args.indexes, interval=args.interval)
+    for events in tail.stream():
+        for event in events:
+            print(json.dumps(event, ensure_ascii=False, default=str))
+        if llm is not None:
+            print(analyze_delta(llm, tail.format_delta(events)))
+
+if __name__ == "__main__":
+    main()
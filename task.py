@@ -1,7 +1,19 @@
 from crewai import Task
+from pydantic import BaseModel, Field
+from typing import Optional
+from tool import LogRetrievalToolInput
+
+
+class RetrievalSpec(BaseModel):
+    """结构化查询改写结果：自由文本规格说明 + 可直接执行的单IP检索参数"""
+    Specification: str = Field(..., description="按Agent要求格式书写的完整查询规格说明")
+    Retrieval: Optional[LogRetrievalToolInput] = Field(
+        None, description="仅当问题是对单个IP的直接日志检索时给出，否则为null"
+    )
+
 
 class QueryRewriteTask(Task):
-    def __init__(self, *args, user_question="", extra_information="", agent=None, **kwargs):
+    def __init__(self, *args, user_question="", extra_information="", agent=None, structured=False, **kwargs):
         # 先格式化描述字符串
         description = """You are given a user question and additional contextual information.
             Your task is to rewrite and integrate them into a single, structured query specification
@@ -23,7 +35,25 @@ class QueryRewriteTask(Task):
                 user_question=user_question, 
                 extra_information=extra_information
             )
-        
+
+        if structured:
+            # 直接输出检索工具的参数，由流程校验后直接执行检索
+            description += """
+            Structured Output:
+            Output ONLY a JSON object with the following fields:
+            - Specification: the complete query specification as text, in the structured format required by the agent
+            - Retrieval: an object with the fields below ONLY IF the question is a direct log lookup for exactly ONE IP
+              address, with no account filter, no account/IP pivot (e.g. "which accounts used this IP"),
+              no subnet or IP range and no multiple entities; otherwise null
+              - Ip: the target IP address
+              - Index: the ELK index name, chosen from the extra information
+              - Url: the ELK cluster url, or an empty string if unknown
+              - Account: null
+              - StartTime: query start time in the format YYYY-MM-DD HH:MM:SS, or null
+              - EndTime: query end time in the format YYYY-MM-DD HH:MM:SS, or null"""
+            kwargs.setdefault("expected_output", "A JSON object with the query specification and optional direct retrieval arguments")
+            kwargs.setdefault("output_pydantic", RetrievalSpec)
+
         kwargs.setdefault("description", description)
         kwargs.setdefault("expected_output", "A structured query specification")
         kwargs.setdefault("agent", agent)
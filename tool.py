@@ -1,10 +1,18 @@
 from crewai.tools import BaseTool
 from pydantic import BaseModel, Field
-from typing import Type, Optional
+from typing import Type, Optional, List, Dict
 from datetime import timedelta, datetime
 import os
+import asyncio
 from elasticsearch import Elasticsearch
 import fnmatch
+import ipaddress
+from singleflight import SingleFlight
+
+try:
+    from elasticsearch.serializer import OrjsonSerializer
+except ImportError:
+    OrjsonSerializer = None
 
 elasticsearch_usr = os.environ.get("ELK_USR", "")
 elasticsearch_pwd = os.environ.get("ELK_PWD", "")
@@ -50,6 +58,7 @@ FIELD_MAPPINGS = {
     },
     "email_user_action_2026*": {
         "ip_field": "IP",
+        "account_field": "account",
         "timestamp_field": "create_date"
     },
     "email_firewall*": {
@@ -66,6 +75,7 @@ FIELD_MAPPINGS = {
     },
     "pass_user_action_2026*": {
         "ip_field": "IP",
+        "account_field": "account",
         "timestamp_field": "create_date"
     },
     "pass_security_bastion*": {
@@ -93,12 +103,61 @@ FIELD_MAPPINGS = {
     },
 }
 
+# 检索只需要文档内容，裁剪掉响应中不使用的元数据
+SEARCH_FILTER_PATH = ["hits.hits._source"]
+
+# 预检后按匹配总数选择检索策略的阈值
+FETCH_ALL_LIMIT = 5000
+PAGED_LIMIT = 100000
+PAGED_CAP = 10000
+SAMPLE_LIMIT = 1000000
+SAMPLE_BUCKETS = 50
+SAMPLE_SIZE = 5000
+# 两跳关联时每个IP在每个索引中最多聚合出的账号数
+PIVOT_ACCOUNT_LIMIT = 100
+
+# 策略执行失败时依次回退到的更轻量的策略
+STRATEGY_FALLBACKS = {
+    "fetch_all": ["sample", "aggregations"],
+    "paged": ["sample", "aggregations"],
+    "sample": ["aggregations"],
+    "aggregations": [],
+}
+STRATEGY_DESCRIPTIONS = {
+    "fetch_all": "全量返回",
+    "paged": f"分页拉取最近的记录（上限 {PAGED_CAP} 条）",
+    "sample": f"按时间分层抽样（{SAMPLE_BUCKETS} 个时间桶，共约 {SAMPLE_SIZE} 条）",
+    "aggregations": "聚合统计（匹配量过大，仅返回统计结果）",
+}
+
+def format_to_markdown(data_list):
+    """将字典列表格式化为Markdown表格"""
+
+    if not data_list:
+        return ""
+
+    # 收集所有字典中出现过的键
+    headers = list(dict.fromkeys(key for item in data_list for key in item.keys()))
+
+    lines = [
+        "| " + " | ".join(headers) + " |",
+        "| " + " | ".join(["---"] * len(headers)) + " |",
+    ]
+    for item in data_list:
+        # 使用get方法，如果键不存在则返回空字符串
+        lines.append("| " + " | ".join(str(item.get(header, "")) for header in headers) + " |")
+    return "\n".join(lines) + "\n"
+
+
+# 相同条件的并发检索只向ES发起一次查询
+retrieval_flight = SingleFlight("log_retrieval")
+
 class LogRetrievalToolInput(BaseModel):
     """Input schema for MyCustomTool."""
     Ip: str = Field(..., description="目标IP地址")
     Index: str = Field(..., description="ELK索引名称")
     Url: str = Field(..., description="ELK集群地址")
-    Account: str = Field(..., description="用户账号")
+    Account: Optional[str] = Field(None, description="用户账号（未参与查询，按账号检索请使用EntityPivotRetrieval）")
     StartTime: Optional[str] = Field(None, description="查询开始时间，格式为YYYY-MM-DD HH:MM:SS，默认为过去24小时")
     EndTime: Optional[str] = Field(None, description="查询结束时间，格式为YYYY-MM-DD HH:MM:SS，默认为当前时间")
     
@@ -129,58 +188,63 @@ class LogRetrievalBasedOnIp(BaseTool):
 
     def _format_to_markdown(self, data_list):
         """将字典列表格式化为Markdown表格"""
+        return format_to_markdown(data_list)
 
-        if not data_list:
-            return ""
+    def _parse_time_range(self, StartTime: Optional[str], EndTime: Optional[str]):
+        """将查询时间转换为整数时间戳（秒），默认为过去1小时"""
+        if StartTime is None:
+            start_time = datetime.now() - timedelta(hours=1)
+            start = int(start_time.timestamp())
+        else:
+            start = int(datetime.strptime(StartTime, "%Y-%m-%d %H:%M:%S").timestamp())
 
-        # 收集所有字典中出现过的键
-        all_keys = []
-        seen = set()
+        if EndTime is None:
+            end = int(datetime.now().timestamp())
+        else:
+            end = int(datetime.strptime(EndTime, "%Y-%m-%d %H:%M:%S").timestamp())
+        return start, end
 
-        for item in data_list:
-            for key in item.keys():
-                if key not in seen:
-                    seen.add(key)
-                    all_keys.append(key)
+    def _get_es_client(self, index_name: str) -> Elasticsearch:
+        """创建ES客户端；安装了orjson时使用orjson序列化。调用方用完后负责关闭"""
+        options = {}
+        if OrjsonSerializer is not None:
+            options["serializers"] = {"application/json": OrjsonSerializer()}
+        return Elasticsearch(
+            [self._get_es_url(index_name)],
+            basic_auth=(elasticsearch_usr, elasticsearch_pwd),
+            **options,
+        )
 
-        headers = all_keys
-        markdown = "| " + " | ".join(headers) + " |\n"
-        markdown += "| " + " | ".join(["---"] * len(headers)) + " |\n"
+    def validate_spec(self, spec: LogRetrievalToolInput) -> Optional[str]:
+        """校验结构化检索参数能否直接执行，返回错误信息；校验通过返回None"""
+        try:
+            ipaddress.ip_address(spec.Ip)
+        except ValueError:
+            return f"无效的IP地址: {spec.Ip}"
+        try:
+            self._get_es_url(spec.Index)
+        except ValueError as e:
+            return str(e)
+        try:
+            self._parse_time_range(spec.StartTime, spec.EndTime)
+        except ValueError as e:
+            return f"无效的时间格式: {str(e)}"
+        return None
 
-        for item in data_list:
-            row = []
-            for header in headers:
-                # 使用get方法，如果键不存在则返回空字符串
-                value = item.get(header, "")
-                row.append(str(value))
-            markdown += "| " + " | ".join(row) + " |\n"
+    def _run(self, Ip: str, Index: str, Url: Optional[str] = None, Account: Optional[str] = None, StartTime: Optional[str] = None, EndTime: Optional[str] = None) -> str:
+        # Url由索引路由决定、Account未参与查询，因此不作为合并的key
+        return retrieval_flight.do((Ip, Index, StartTime, EndTime), self._search, Ip, Index, StartTime, EndTime)
 
-        return markdown
+    async def _arun(self, Ip: str, Index: str, Url: Optional[str] = None, Account: Optional[str] = None, StartTime: Optional[str] = None, EndTime: Optional[str] = None) -> str:
+        return await retrieval_flight.ado((Ip, Index, StartTime, EndTime), self._search, Ip, Index, StartTime, EndTime)
 
-    def _run(self, Ip: str, Index: str, Url: str, Account: str, StartTime: Optional[str] = None, EndTime: Optional[str] = None) -> str:
+    def _search(self, Ip: str, Index: str, StartTime: Optional[str] = None, EndTime: Optional[str] = None) -> str:
         #url = "http://159.226.16.247:9200/"
         #print("Using Elasticsearch username:", elasticsearch_usr)
         #print("Using Elasticsearch password:", elasticsearch_pwd)
-        # 注意：这里需要通过其他方式获取默认时间，因为无法直接在类上调用实例方法
-        if StartTime is None:
-            now = datetime.now()
-            start_time = now - timedelta(hours=1)
-            StartTime = int(start_time.timestamp())  # 转为整数时间戳（秒）
-        else:
-            StartTime = int(datetime.strptime(StartTime, "%Y-%m-%d %H:%M:%S").timestamp())
-
-        if EndTime is None:
-            EndTime = int(datetime.now().timestamp())
-        else:
-            EndTime = int(datetime.strptime(EndTime, "%Y-%m-%d %H:%M:%S").timestamp())
+        StartTime, EndTime = self._parse_time_range(StartTime, EndTime)
 
         print("Using start time:", StartTime, "Using end time:", EndTime)
-        es_url = self._get_es_url(Index)
-        es = Elasticsearch(
-            [es_url],
-            basic_auth=(elasticsearch_usr, elasticsearch_pwd)
-        )
-
         # 检测字段
         field_mapping = self._get_field_mapping(Index)
         ip_field = field_mapping["ip_field"]
@@ -227,22 +291,302 @@ class LogRetrievalBasedOnIp(BaseTool):
 
         print(f"使用的查询条件: {query}")
 
+        # 同一次检索的预检和各策略共用一个客户端
+        es = self._get_es_client(Index)
         try:
-            response = es.search(index=Index, body=query, size=5000, scroll='2m')
-
-            # 提取命中的数据
-            hits = response['hits']['hits']
-            if hits:
-                # 提取源数据并转换为列表格式
-                data_list = [hit['_source'] for hit in hits]
-                # 将结果格式化为markdown表格
-                markdown_result = self._format_to_markdown(data_list)
-                return f"找到 {len(hits)} 条记录:\n\n" + markdown_result
-            else:
+            # 预检：先统计匹配总数，再选择检索策略
+            total = es.count(index=Index, query=query["query"])["count"]
+            if not total:
                 return f"在索引 {Index} 中未找到匹配 IP {Ip} 的日志数据"
 
+            strategy = self._plan_strategy(total)
+            print(f"[INFO] 匹配总数 {total}，检索策略 {strategy}")
+            fallback_notes = []
+            for strategy in [strategy] + STRATEGY_FALLBACKS[strategy]:
+                try:
+                    returned, markdown_result = self._execute_strategy(strategy, es, Index, query, field_mapping)
+                    break
+                except Exception as e:
+                    print(f"[WARN] 检索策略 {strategy} 执行失败: {str(e)}")
+                    fallback_notes.append(f"{STRATEGY_DESCRIPTIONS[strategy]}失败（{str(e)}）")
+            else:
+                return f"查询失败: {'；'.join(fallback_notes)}"
+
+            if strategy == "aggregations":
+                returned_note = "未返回原始记录，仅返回聚合统计"
+            else:
+                returned_note = self._returned_note(total, returned)
+            header = f"检索策略: {STRATEGY_DESCRIPTIONS[strategy]}\n"
+            if fallback_notes:
+                header += f"回退说明: {'；'.join(fallback_notes)}，已回退到当前策略\n"
+            header += f"匹配总数: {total} 条，{returned_note}\n"
+            return header + "\n" + markdown_result
+
         except Exception as e:
             return f"查询失败: {str(e)}"
+        finally:
+            es.close()
+
+    def _execute_strategy(self, strategy: str, es: Elasticsearch, Index: str, query: dict, field_mapping: dict):
+        """执行指定的检索策略，返回 (返回条数, Markdown结果)"""
+        time_field = field_mapping["timestamp_field"]
+        if strategy == "fetch_all":
+            return self._fetch_all(es, Index, query)
+        if strategy == "paged":
+            return self._fetch_paged(es, Index, query, time_field)
+        if strategy == "sample":
+            return self._fetch_sample(es, Index, query, time_field)
+        return self._fetch_aggregations(es, Index, query, field_mapping)
+
+    def _returned_note(self, total: int, returned: int) -> str:
+        """返回条数说明，少于匹配总数时标注截断"""
+        return f"返回 {returned} 条{'（结果已截断）' if returned < total else ''}"
+
+    def _plan_strategy(self, total: int) -> str:
+        """根据匹配总数选择检索策略"""
+        if total <= FETCH_ALL_LIMIT:
+            return "fetch_all"
+        if total <= PAGED_LIMIT:
+            return "paged"
+        if total <= SAMPLE_LIMIT:
+            return "sample"
+        return "aggregations"
+
+    def _fetch_all(self, es: Elasticsearch, Index: str, query: dict):
+        # 预检之后仍可能有新文档写入，按上限取数，由调用方比较返回条数与匹配总数
+        response = es.search(index=Index, body=query, size=FETCH_ALL_LIMIT, filter_path=SEARCH_FILTER_PATH)
+        data_list = [hit["_source"] for hit in response.get("hits", {}).get("hits", [])]
+        return len(data_list), self._format_to_markdown(data_list)
+
+    def _fetch_paged(self, es: Elasticsearch, Index: str, query: dict, time_field: str):
+        """用PIT + search_after按时间倒序分页拉取，最多返回最近的PAGED_CAP条"""
+        pit = es.open_point_in_time(index=Index, keep_alive="2m")["id"]
+        data_list = []
+        search_after = None
+        try:
+            while len(data_list) < PAGED_CAP:
+                body = {
+                    "query": query["query"],
+                    "pit": {"id": pit, "keep_alive": "2m"},
+                    "sort": [{time_field: "desc"}, {"_shard_doc": "desc"}],
+                    "size": min(FETCH_ALL_LIMIT, PAGED_CAP - len(data_list)),
+                }
+                if search_after is not None:
+                    body["search_after"] = search_after
+                response = es.search(body=body, filter_path=["pit_id", "hits.hits._source", "hits.hits.sort"])
+                pit = response.get("pit_id", pit)
+                hits = response.get("hits", {}).get("hits", [])
+                if not hits:
+                    break
+                data_list.extend(hit["_source"] for hit in hits)
+                search_after = hits[-1]["sort"]
+        finally:
+            es.close_point_in_time(id=pit)
+        return len(data_list), self._format_to_markdown(data_list)
+
+    def _fetch_sample(self, es: Elasticsearch, Index: str, query: dict, time_field: str):
+        """按时间分桶分层抽样，每个时间桶取等量文档"""
+        body = {
+            "query": query["query"],
+            "size": 0,
+            "aggs": {
+                "timeline": {
+                    "auto_date_histogram": {"field": time_field, "buckets": SAMPLE_BUCKETS},
+                    "aggs": {
+                        "sample": {"top_hits": {"size": SAMPLE_SIZE // SAMPLE_BUCKETS, "sort": [{time_field: "asc"}]}}
+                    },
+                }
+            },
+        }
+        response = es.search(index=Index, body=body)
+        data_list = [
+            hit["_source"]
+            for bucket in response["aggregations"]["timeline"]["buckets"]
+            for hit in bucket["sample"]["hits"]["hits"]
+        ]
+        return len(data_list), self._format_to_markdown(data_list)
+
+    def _fetch_aggregations(self, es: Elasticsearch, Index: str, query: dict, field_mapping: dict):
+        """匹配量过大时只返回聚合统计：时间分布，以及已映射账号字段的Top账号"""
+        time_field = field_mapping["timestamp_field"]
+        aggs = {"timeline": {"auto_date_histogram": {"field": time_field, "buckets": SAMPLE_BUCKETS}}}
+        account_field = field_mapping.get("account_field")
+        if account_field:
+            aggs["top_accounts"] = {"terms": {"field": account_field, "size": 20}}
+        body = {"query": query["query"], "size": 0, "aggs": aggs}
+        response = es.search(index=Index, body=body)
+
+        timeline = [
+            {"时间": bucket.get("key_as_string", bucket["key"]), "记录数": bucket["doc_count"]}
+            for bucket in response["aggregations"]["timeline"]["buckets"]
+        ]
+        markdown = "### 时间分布\n\n" + self._format_to_markdown(timeline)
+        if account_field:
+            accounts = [
+                {"账号": bucket["key"], "记录数": bucket["doc_count"]}
+                for bucket in response["aggregations"]["top_accounts"]["buckets"]
+            ]
+            markdown += "\n### Top账号\n\n" + self._format_to_markdown(accounts)
+        return 0, markdown
+
+class EntityPivotToolInput(BaseModel):
+    """Input schema for EntityPivotRetrieval."""
+    Ips: List[str] = Field(default_factory=list, description="目标IP地址列表")
+    Accounts: List[str] = Field(default_factory=list, description="目标用户账号列表")
+    Indexes: List[str] = Field(..., description="ELK索引名称列表")
+    PivotToAccounts: bool = Field(False, description="是否进行两跳关联：先查出这些IP使用过的账号，再检索这些账号的全部行为")
+    StartTime: Optional[str] = Field(None, description="查询开始时间，格式为YYYY-MM-DD HH:MM:SS，默认为过去1小时")
+    EndTime: Optional[str] = Field(None, description="查询结束时间，格式为YYYY-MM-DD HH:MM:SS，默认为当前时间")
+
+
+class EntityPivotRetrieval(LogRetrievalBasedOnIp):
+    name: str = "EntityPivotRetrieval"
+    description: str = """批量实体关联检索工具：一次调用即可检索多个IP和/或多个账号的日志，每个索引只发起一次terms查询，结果按实体分组返回；支持IP→账号→行为的两跳关联检索\n\n    When to use:\n    - 当需要同时检索多个IP或多个账号的日志时\n    - 当需要查询某个IP在哪些账号上使用过时\n    - 当需要进一步查询这些账号做了什么时（PivotToAccounts=true）"""
+    args_schema: Type[BaseModel] = EntityPivotToolInput
+
+    def _get_field_values(self, source: dict, field: str) -> List[str]:
+        """按字段路径（支持a.b形式的嵌套字段）从文档中取值"""
+        if field in source:
+            value = source[field]
+        else:
+            value = source
+            for part in field.split("."):
+                if not isinstance(value, dict) or part not in value:
+                    return []
+                value = value[part]
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return [str(v) for v in value]
+        return [str(value)]
+
+    def _terms_query(self, fields, values: List[str]) -> dict:
+        if isinstance(fields, list):
+            return {"bool": {"should": [{"terms": {field: values}} for field in fields], "minimum_should_match": 1}}
+        return {"terms": {fields: values}}
+
+    def _retrieve_grouped(self, Indexes: List[str], field_key: str, values: List[str], start: int, end: int,
+                          pivot: bool = False):
+        """对每个索引执行一次terms查询，返回 {实体: {索引: {"total": 匹配总数, "docs": [文档]}}}、
+        {实体: [关联账号]} 以及提示信息
+
+        每个实体在每个索引中的匹配总数由filters聚合统计，不受返回文档数上限影响；
+        pivot=True时在同一次查询中按账号字段做terms聚合，关联账号不依赖被截断的文档。
+        """
+        grouped: Dict[str, Dict[str, dict]] = {value: {} for value in values}
+        accounts: Dict[str, List[str]] = {value: [] for value in values}
+        notes = []
+        for Index in Indexes:
+            field_mapping = self._get_field_mapping(Index)
+            fields = field_mapping.get(field_key)
+            time_field = field_mapping["timestamp_field"]
+            if not fields:
+                notes.append(f"索引 {Index} 未配置 {field_key}，已跳过")
+                continue
+
+            entities = {"filters": {"filters": [self._terms_query(fields, [value]) for value in values]}}
+            account_field = field_mapping.get("account_field")
+            if pivot and account_field:
+                entities["aggs"] = {"accounts": {"terms": {"field": account_field, "size": PIVOT_ACCOUNT_LIMIT}}}
+            query = {
+                "query": {
+                    "bool": {
+                        "must": [
+                            self._terms_query(fields, values),
+                            {"range": {time_field: {"gte": str(start), "lte": str(end)}}},
+                        ]
+                    }
+                },
+                # 超出返回上限时优先保留最近的记录
+                "sort": [{time_field: "desc"}],
+                "aggs": {"entities": entities},
+            }
+            print(f"使用的查询条件: {query}")
+            es = self._get_es_client(Index)
+            try:
+                response = es.search(index=Index, body=query, size=FETCH_ALL_LIMIT,
+                                     filter_path=SEARCH_FILTER_PATH + ["aggregations"])
+            except Exception as e:
+                notes.append(f"索引 {Index} 查询失败: {str(e)}")
+                continue
+            finally:
+                es.close()
+
+            buckets = response["aggregations"]["entities"]["buckets"]
+            for value, bucket in zip(values, buckets):
+                if bucket["doc_count"]:
+                    grouped[value][Index] = {"total": bucket["doc_count"], "docs": []}
+                if "accounts" in bucket:
+                    found = accounts[value]
+                    found.extend(b["key"] for b in bucket["accounts"]["buckets"] if b["key"] not in found)
+                    if bucket["accounts"]["sum_other_doc_count"]:
+                        notes.append(f"索引 {Index} 中 IP {value} 关联的账号超过 {PIVOT_ACCOUNT_LIMIT} 个，仅使用记录数最多的 {PIVOT_ACCOUNT_LIMIT} 个")
+
+            hits = response.get("hits", {}).get("hits", [])
+            field_list = fields if isinstance(fields, list) else [fields]
+            for hit in hits:
+                source = hit["_source"]
+                matched = set()
+                for field in field_list:
+                    matched.update(v for v in self._get_field_values(source, field) if v in grouped)
+                for value in matched:
+                    grouped[value].setdefault(Index, {"total": 0, "docs": []})["docs"].append(source)
+
+            if len(hits) == FETCH_ALL_LIMIT:
+                notes.append(f"索引 {Index} 匹配记录超过单次返回上限 {FETCH_ALL_LIMIT} 条，仅返回最近的 {FETCH_ALL_LIMIT} 条")
+        return grouped, accounts, notes
+
+    def _format_grouped(self, title: str, grouped: Dict[str, Dict[str, dict]]) -> str:
+        sections = []
+        for entity, by_index in grouped.items():
+            total = sum(result["total"] for result in by_index.values())
+            section = f"## {title} {entity}（匹配总数 {total} 条）\n"
+            if not by_index:
+                section += "\n未找到匹配的日志数据\n"
+            for Index, result in by_index.items():
+                section += (
+                    f"\n### 索引 {Index}（匹配总数 {result['total']} 条，"
+                    f"{self._returned_note(result['total'], len(result['docs']))}）\n\n"
+                    + self._format_to_markdown(result["docs"])
+                )
+            sections.append(section)
+        return "\n".join(sections)
+
+    def _run(self, Indexes: List[str], Ips: Optional[List[str]] = None, Accounts: Optional[List[str]] = None,
+             PivotToAccounts: bool = False, StartTime: Optional[str] = None, EndTime: Optional[str] = None) -> str:
+        Ips = list(dict.fromkeys(Ips or []))
+        Accounts = list(dict.fromkeys(Accounts or []))
+        if not Ips and not Accounts:
+            return "错误: 至少需要提供一个IP或账号。"
+
+        start, end = self._parse_time_range(StartTime, EndTime)
+        print("Using start time:", start, "Using end time:", end)
+
+        outputs = []
+        notes = []
+        if Ips:
+            ip_grouped, ip_accounts, ip_notes = self._retrieve_grouped(Indexes, "ip_field", Ips, start, end,
+                                                                       pivot=PivotToAccounts)
+            notes.extend(ip_notes)
+            outputs.append(self._format_grouped("IP", ip_grouped))
+
+            if PivotToAccounts:
+                pivot = "\n".join(f"- {ip}: {', '.join(accounts) or '无'}" for ip, accounts in ip_accounts.items())
+                outputs.append("## IP关联账号\n\n" + pivot + "\n")
+                for accounts in ip_accounts.values():
+                    Accounts.extend(a for a in accounts if a not in Accounts)
+
+        if Accounts:
+            account_grouped, _, account_notes = self._retrieve_grouped(Indexes, "account_field", Accounts, start, end)
+            notes.extend(account_notes)
+            outputs.append(self._format_grouped("账号", account_grouped))
+
+        if notes:
+            outputs.append("## 提示\n\n" + "\n".join(f"- {note}" for note in notes) + "\n")
+        return "\n".join(outputs)
+
+    async def _arun(self, *args, **kwargs) -> str:
+        return await asyncio.to_thread(self._run, *args, **kwargs)
 
 
 def main():